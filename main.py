@@ -19,13 +19,15 @@
 
     4. **Descarga de Resultados**:
        - Los usuarios pueden descargar los datos procesados en formato Excel.
-       - También pueden descargar un archivo ZIP que incluye el Excel y los PDFs asociados.
+       - También pueden descargar un archivo ZIP que incluye los datos (Excel o Parquet) y los PDFs asociados.
 
     5. **Visualización de PDFs Asociados**:
        - Los usuarios pueden seleccionar y visualizar los archivos PDF asociados directamente en la aplicación.
 
     Notas:
       - La aplicación utiliza `st.session_state` para almacenar los resultados procesados y los archivos PDF.
+      - Si se vuelve a presionar "Procesar archivos" sin haber subido archivos nuevos (mismo `file_id`), se
+        reutilizan los resultados guardados sin volver a procesar.
       - Se manejan casos en los que no se encuentran XML válidos o PDFs asociados.
       - La interfaz incluye mensajes de advertencia, éxito e información para mejorar la experiencia del usuario.
 
@@ -36,13 +38,42 @@
     Dependencias:
       - Streamlit
       - Pandas
-      - Funciones auxiliares del módulo `pdf_handler` (`process_uploaded_files`, `generar_zip`).
+      - XlsxWriter y PyArrow (exportación a Excel y Parquet)
+      - Funciones auxiliares del módulo `pdf_handler` (`process_uploaded_files`, `build_excel_bytes`, `build_zip_bytes`).
 """
 import os
 import base64
-from io import BytesIO
+import pandas as pd
 import streamlit as st
-from pdf_handler import process_uploaded_files, generar_zip
+from pdf_handler import process_uploaded_files, build_excel_bytes, build_zip_bytes
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def pdf_b64(path: str, mtime: float) -> str:
+    """
+    Devuelve el contenido de un PDF codificado en base64 para la vista previa.
+    La fecha de modificación forma parte de la llave de caché, así que si el archivo cambia
+    se vuelve a leer; en otro caso cambiar de PDF en el selector no vuelve a leer ni codificar.
+    """
+    with open(path, "rb") as f:
+        return base64.b64encode(f.read()).decode('ascii')
+
+def combustible_totals(df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Calcula las sumas de litros facturados y transportados por tipo de combustible, en el orden en
+    que aparece cada combustible. Se calcula una sola vez al procesar los archivos y se guarda en
+    `st.session_state`, para que el filtro por combustible sea una consulta directa en cada interacción.
+    """
+    return df.groupby('Combustible', observed=True, sort=False)[
+        ['Cantidad Litros Facturada', 'Litros Transportada']
+    ].sum()
+
+def pdfs_for_preview(df: pd.DataFrame) -> list:
+    """
+    Devuelve los nombres únicos de los PDFs asociados (sin 'No encontrado') para el selector de
+    vista previa. Se calcula una sola vez al procesar los archivos y se guarda en `st.session_state`.
+    """
+    pdfs = df['PDF Asociado']
+    return pdfs[pdfs != 'No encontrado'].unique().tolist()
 
 def main():
     st.title("📁 Verificación Cartaportes")
@@ -55,9 +86,18 @@ def main():
 
     if st.button("🚀 Procesar archivos"):
         if uploaded_files:
-            df_result, pdf_files = process_uploaded_files(uploaded_files)
-            st.session_state.df_result = df_result
-            st.session_state.pdf_files = pdf_files
+            # Si los archivos subidos no cambiaron, se reutilizan los resultados ya procesados.
+            # `file_id` es estable entre interacciones y cambia cada vez que se vuelve a subir un archivo.
+            sig = tuple(f.file_id for f in uploaded_files)
+            if sig == st.session_state.get("last_sig") and "df_result" in st.session_state:
+                df_result = st.session_state.df_result
+            else:
+                df_result, pdf_files = process_uploaded_files(uploaded_files)
+                st.session_state.df_result = df_result
+                st.session_state.pdf_files = pdf_files
+                st.session_state.totales_combustible = combustible_totals(df_result)
+                st.session_state.archivos_con_pdf = pdfs_for_preview(df_result)
+                st.session_state.last_sig = sig
 
             if not df_result.empty:
                 st.success("✅ Datos procesados correctamente:")
@@ -67,7 +107,13 @@ def main():
             st.warning("⚠️ Por favor sube archivos antes de procesar.")
 
     if "df_result" in st.session_state and not st.session_state.df_result.empty:
-        st.dataframe(st.session_state.df_result)
+        st.dataframe(
+            st.session_state.df_result,
+            column_config={
+                "Cantidad Litros Facturada": st.column_config.NumberColumn(format="%.3f"),
+                "Litros Transportada": st.column_config.NumberColumn(format="%.3f"),
+            }
+        )
 
         total_facturada = st.session_state.df_result["Cantidad Litros Facturada"].sum()
         total_transportada = st.session_state.df_result["Litros Transportada"].sum()
@@ -75,32 +121,35 @@ def main():
         st.write(f"**Suma total Facturada (todas las filas):** {total_facturada:.3f}")
         st.write(f"**Suma total Transportada (todas las filas):** {total_transportada:.3f}")
 
-        combustibles_unicos = st.session_state.df_result["Combustible"].dropna().unique()
-        if len(combustibles_unicos) > 0:
-            combustible_seleccionado = st.selectbox("Filtrar suma por combustible:", options=combustibles_unicos)
-            df_filtrado = st.session_state.df_result[st.session_state.df_result["Combustible"] == combustible_seleccionado]
-            total_facturada_filtrada = df_filtrado["Cantidad Litros Facturada"].sum()
-            total_transportada_filtrada = df_filtrado["Litros Transportada"].sum()
+        totales = st.session_state.totales_combustible
+        if len(totales) > 0:
+            combustible_seleccionado = st.selectbox("Filtrar suma por combustible:", options=totales.index.tolist())
+            total_facturada_filtrada = totales.loc[combustible_seleccionado, "Cantidad Litros Facturada"]
+            total_transportada_filtrada = totales.loc[combustible_seleccionado, "Litros Transportada"]
             st.write(f"Suma total Facturada para **{combustible_seleccionado}**: {total_facturada_filtrada:.3f}")
             st.write(f"Suma total Transportada para **{combustible_seleccionado}**: {total_transportada_filtrada:.3f}")
         else:
             st.info("No se encontraron valores de combustible para filtrar.")
 
         # Descarga de Excel
-        excel_buffer = BytesIO()
-        st.session_state.df_result.to_excel(excel_buffer, index=False)
-        excel_buffer.seek(0)
+        excel_bytes = build_excel_bytes(st.session_state.df_result)
         st.download_button(
             "📥 Descargar Excel (solo datos)",
-            data=excel_buffer,
+            data=excel_bytes,
             file_name="datos_procesados.xlsx",
             mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
         )
 
-        # Descarga de ZIP (Excel + PDFs asociados)
-        zip_buffer = generar_zip(st.session_state.df_result, st.session_state.pdf_files)
+        # Descarga de ZIP (Excel o Parquet + PDFs asociados)
+        formato_zip = st.radio(
+            "Formato de los datos dentro del ZIP:",
+            options=["xlsx", "parquet"],
+            format_func=lambda fmt: "Excel (.xlsx)" if fmt == "xlsx" else "Parquet (más ligero)",
+            horizontal=True
+        )
+        zip_buffer = build_zip_bytes(st.session_state.df_result, st.session_state.pdf_files, formato_zip)
         st.download_button(
-            "📥 Descargar ZIP (Excel + PDFs asociados)",
+            "📥 Descargar ZIP (datos + PDFs asociados)",
             data=zip_buffer,
             file_name="datos_y_pdfs.zip",
             mime="application/zip"
@@ -108,17 +157,14 @@ def main():
 
         st.markdown("---")
         st.subheader("📄 **Visualizar PDF asociado**")
-        archivos_con_pdf = st.session_state.df_result[
-            st.session_state.df_result['PDF Asociado'] != 'No encontrado'
-        ]['PDF Asociado'].unique().tolist()
+        archivos_con_pdf = st.session_state.archivos_con_pdf
 
         if archivos_con_pdf:
             selected_pdf = st.selectbox("Selecciona un PDF para visualizar:", archivos_con_pdf)
             pdf_path = st.session_state.pdf_files[selected_pdf]
 
             if os.path.exists(pdf_path):
-                with open(pdf_path, "rb") as f:
-                    base64_pdf = base64.b64encode(f.read()).decode('utf-8')
+                base64_pdf = pdf_b64(pdf_path, os.path.getmtime(pdf_path))
                 pdf_display = f'''
                     <iframe src="data:application/pdf;base64,{base64_pdf}"
                             width="100%" height="700"
@@ -1,44 +1,120 @@
 # pdf_handler.py
 
+import ntpath
 import os
 import shutil
 import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from io import BytesIO
+from typing import Literal
+import numpy as np
 import pandas as pd
 import streamlit as st
+import xlsxwriter
 from xml_processor import process_file_based_on_format
 
-def identify_pdf(xml_filename: str, pdf_files: dict) -> str:
+def identify_pdf(xml_filename: str, pdf_index: dict) -> str:
     """Identifica el archivo PDF asociado a un archivo XML dado.
-    Esta función toma el nombre de un archivo XML y un diccionario que contiene
-    los nombres de archivos PDF disponibles. Busca un archivo PDF cuyo nombre base
-    coincida con el del archivo XML (es decir, el nombre del archivo sin la extensión)
-    y devuelve el nombre del archivo PDF si se encuentra. Si no se encuentra un archivo
-    PDF correspondiente, devuelve 'No encontrado'.
+    Esta función toma el nombre de un archivo XML y un índice de los archivos PDF disponibles
+    construido con `build_pdf_index`. Busca un archivo PDF cuyo nombre base coincida con el del
+    archivo XML (es decir, el nombre del archivo sin la extensión, sin distinguir mayúsculas y
+    minúsculas) y devuelve el nombre real del archivo PDF si se encuentra. Si no se encuentra un
+    archivo PDF correspondiente, devuelve 'No encontrado'.
     Parámetros:
     ----------
     xml_filename : str
         El nombre del archivo XML (incluyendo la extensión .xml).
-    pdf_files : dict
-        Un diccionario donde las claves son los nombres de los archivos PDF disponibles.
+    pdf_index : dict
+        Un diccionario cuyas claves son los nombres base en minúsculas de los PDFs y cuyos valores
+        son tuplas (nombre del PDF, ruta completa).
     Retorna:
     -------
     str
         El nombre del archivo PDF asociado si existe, o 'No encontrado' si no se encuentra."""
 
+    base_name = os.path.splitext(xml_filename)[0].lower()
+    return pdf_index.get(base_name, (None, None))[0] or 'No encontrado'
+
+def build_pdf_index(pdf_files: dict) -> dict:
+    """
+    Construye un índice de los PDFs por nombre base en minúsculas, para que `identify_pdf`
+    encuentre el PDF de un XML aunque difieran mayúsculas/minúsculas (por ejemplo `.PDF` y `.pdf`).
+    """
+    return {os.path.splitext(name)[0].lower(): (name, path) for name, path in pdf_files.items()}
+
+def _to_liters(values: list) -> pd.Series:
+    """
+    Convierte las cantidades crudas de los XML a float con la misma regla que `float()`: los valores
+    vacíos o inválidos valen 0.0, pero un 'nan' explícito se conserva como NaN.
+    """
+    raw = pd.Series(values, dtype=object)
+    liters = pd.to_numeric(raw, errors='coerce')
+    nan_literal = raw.str.strip().str.lstrip('+-').str.lower().eq('nan')
+    return liters.fillna(0.0).mask(nan_literal.fillna(False).astype(bool))
+
+def _walk(path: str):
+    """
+    Recorre recursivamente un directorio con `os.scandir` y devuelve sus archivos como `DirEntry`,
+    aprovechando la información de tipo ya obtenida por `scandir` en lugar de consultar cada archivo.
+    """
+    with os.scandir(path) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _walk(entry.path)
+            else:
+                yield entry
+
+def _relative_path(name: str) -> str:
     """
-    Busca el PDF asociado a un archivo XML.
+    Normaliza la ruta de un archivo subido o de una entrada de ZIP a la ruta relativa que tendría
+    dentro del directorio temporal: se quita la unidad (`C:`) y se descartan componentes absolutos,
+    '.' o '..'.
     """
-    base_name = os.path.splitext(xml_filename)[0]
-    pdf_name = base_name + ".pdf"
-    return pdf_name if pdf_name in pdf_files else 'No encontrado'
+    name = ntpath.splitdrive(name.replace('\\', '/'))[1]
+    return '/'.join(p for p in name.split('/') if p not in ('', '.', '..'))
+
+def _safe_target(temp_dir: str, name: str) -> str | None:
+    """
+    Devuelve la ruta dentro de `temp_dir` donde se guardará el archivo `name`, o `None` si, una vez
+    resuelta, quedaría fuera de `temp_dir` (por ejemplo, una entrada de ZIP con unidad o '..').
+    """
+    target = os.path.join(temp_dir, *_relative_path(name).split('/'))
+    base = os.path.realpath(temp_dir)
+    resolved = os.path.realpath(target)
+    if resolved == base or os.path.commonpath([base, resolved]) != base:
+        return None
+    return target
+
+def _read_zip(zip_source, temp_dir: str, xml_blobs: dict) -> None:
+    """
+    Recorre las entradas de un ZIP sin extraerlo completo a disco:
+      - Los XML se leen en memoria y se guardan en `xml_blobs` con su ruta relativa como llave; si la
+        misma ruta llega más de una vez se conserva la última, como al sobrescribir el archivo en disco.
+      - Los PDF se copian por bloques dentro de `temp_dir`, conservando su ruta relativa dentro del ZIP,
+        porque se necesitan después para la vista previa y el ZIP de descarga.
+    """
+    with zipfile.ZipFile(zip_source) as zf:
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            name_lower = info.filename.lower()
+            if name_lower.endswith('.xml'):
+                xml_blobs[_relative_path(info.filename)] = zf.read(info)
+            elif name_lower.endswith('.pdf'):
+                target = _safe_target(temp_dir, info.filename)
+                if target is None:
+                    print(f"Entrada de ZIP ignorada, queda fuera del directorio temporal: {info.filename}")
+                    continue
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with zf.open(info) as src, open(target, 'wb') as dst:
+                    shutil.copyfileobj(src, dst, length=1 << 20)
 
 def process_uploaded_files(uploaded_files) -> tuple[pd.DataFrame, dict]:
     """
     La función `process_uploaded_files` procesa una lista de archivos subidos por el usuario, que pueden
     incluir archivos PDF, XML y ZIP. Realiza las siguientes tareas:
 
-    1. Crea un directorio temporal para almacenar los archivos subidos y extraer el contenido de los ZIP.
+    1. Crea un directorio temporal para almacenar los PDF subidos y los contenidos en los ZIP.
     2. Identifica y recopila los archivos PDF y XML presentes en los archivos subidos o extraídos.
     3. Procesa cada archivo XML para extraer información relevante y asocia el archivo PDF correspondiente.
     4. Devuelve un DataFrame con los datos procesados y un diccionario con los archivos PDF.
@@ -55,23 +131,31 @@ def process_uploaded_files(uploaded_files) -> tuple[pd.DataFrame, dict]:
         - Un diccionario donde las claves son los nombres de los archivos PDF y los valores son sus rutas completas.
 
     Detalles del procesamiento:
-      - Los archivos ZIP se extraen en el directorio temporal para detectar archivos PDF y XML adicionales.
-      - Los archivos XML se procesan utilizando la función `process_file_based_on_format`, que extrae datos específicos
-        según el formato del XML.
-      - Se utiliza la función `identify_pdf` para asociar un archivo PDF al XML basado en el nombre del archivo.
+      - Los archivos ZIP se leen en memoria: sus XML se procesan sin escribirse a disco y solo sus PDF se copian
+        al directorio temporal.
+      - El contenido de cada archivo XML se procesa con la función `process_file_based_on_format`,
+        que extrae datos específicos según el formato del XML.
+      - Se utiliza la función `identify_pdf` para asociar un archivo PDF al XML basado en el nombre del archivo,
+        sin distinguir mayúsculas y minúsculas.
       - Si se detectan errores al procesar un XML, se imprime un mensaje de error en la consola.
+      - Los XML se procesan en paralelo con un `ThreadPoolExecutor` (hasta 32 hilos según los núcleos disponibles);
+        el orden original de los archivos se conserva.
       - Se utiliza una barra de progreso (Streamlit) para mostrar el avance del procesamiento de los XML.
 
     Notas:
-      - El DataFrame resultante incluye columnas como 'Cantidad Litros Facturada' y 'Litros Transportada', que se convierten
-        a tipo float para facilitar cálculos posteriores.
-      - La columna 'FechaEmision' se utiliza para ordenar los datos, pero se elimina antes de devolver el DataFrame.
+      - El DataFrame resultante se construye una sola vez con sus tipos finales: 'Cantidad Litros Facturada' y
+        'Litros Transportada' son float, y 'Combustible' y 'Clave SAT' son categóricas.
+      - La conversión de los litros a float y la columna 'Comparacion' se calculan de forma vectorizada sobre el
+        DataFrame completo, no por cada XML. Los litros se conservan con precisión completa; el formato a 3 decimales
+        se aplica solo al mostrarlos.
+      - La fecha de emisión ('FechaEmision') se utiliza para ordenar los registros antes de construir el DataFrame, por
+        lo que no forma parte de sus columnas.
       - El directorio temporal se elimina y recrea al inicio de la función para garantizar un entorno limpio.
 """
     """
     Procesa los archivos subidos:
-      1. Crea un directorio temporal y extrae ZIPs.
-      2. Recopila los archivos PDF y XML.
+      1. Crea un directorio temporal y lee los ZIPs en memoria.
+      2. Recopila los archivos PDF (en disco) y XML (en memoria).
       3. Procesa cada XML y asocia su PDF correspondiente.
       4. Retorna un DataFrame con la información y un diccionario con los PDFs.
     """
@@ -82,73 +166,163 @@ def process_uploaded_files(uploaded_files) -> tuple[pd.DataFrame, dict]:
 
     pdf_files = {}
 
-    # Guardar archivos y extraer ZIPs
-    for uploaded_file in uploaded_files:
-        file_path = os.path.join(temp_dir, uploaded_file.name)
-        with open(file_path, 'wb') as f:
-            f.write(uploaded_file.getbuffer())
+    xml_blobs = {}
 
-        if uploaded_file.name.lower().endswith('.pdf'):
+    # Guardar PDFs en disco (se necesitan para la vista previa y el ZIP); XMLs y ZIPs se leen en memoria
+    for uploaded_file in uploaded_files:
+        name_lower = uploaded_file.name.lower()
+        if name_lower.endswith('.pdf'):
+            file_path = os.path.join(temp_dir, uploaded_file.name)
+            with open(file_path, 'wb') as f:
+                f.write(uploaded_file.getbuffer())
             pdf_files[uploaded_file.name] = file_path
-        elif uploaded_file.name.lower().endswith('.zip'):
-            with zipfile.ZipFile(file_path, 'r') as zip_ref:
-                zip_ref.extractall(temp_dir)
-
-    # Detectar PDFs extraídos
-    for root_dir, _, files in os.walk(temp_dir):
-        for file in files:
-            if file.lower().endswith('.pdf'):
-                full_path = os.path.join(root_dir, file)
-                pdf_files[file] = full_path
-
-    # Recopilar archivos XML
-    all_xml_files = []
-    for root_dir, _, files in os.walk(temp_dir):
-        for file in files:
-            if file.lower().endswith('.xml'):
-                all_xml_files.append(os.path.join(root_dir, file))
-    all_xml_files = sorted(all_xml_files)
-
-    all_data = []
-    total_xml = len(all_xml_files)
+        elif name_lower.endswith('.xml'):
+            xml_blobs[_relative_path(uploaded_file.name)] = uploaded_file.getvalue()
+        elif name_lower.endswith('.zip'):
+            _read_zip(BytesIO(uploaded_file.getbuffer()), temp_dir, xml_blobs)
+
+    # Detectar PDFs guardados (subidos directamente o copiados desde ZIPs)
+    for entry in _walk(temp_dir):
+        if entry.name.lower().endswith('.pdf'):
+            pdf_files[entry.name] = entry.path
+
+    pdf_index = build_pdf_index(pdf_files)
+    # Un XML que llega varias veces con la misma ruta se procesa una sola vez
+    xml_blobs = sorted(xml_blobs.items())
+
+    results = [None] * len(xml_blobs)
+    total_xml = len(xml_blobs)
     progress_bar = st.progress(0) if total_xml else None
 
-    for idx, xml_path in enumerate(all_xml_files, start=1):
-        try:
-            data = process_file_based_on_format(xml_path)
-            if data:
-                xml_filename = os.path.basename(xml_path)
-                data['XML_File'] = xml_filename
-                data['PDF Asociado'] = identify_pdf(xml_filename, pdf_files)
-                all_data.append(data)
-        except Exception as e:
-            print(f"Error procesando {xml_path}: {e}")
-
-        if progress_bar:
-            progress_bar.progress(idx / total_xml)
-
-    df_result = pd.DataFrame(all_data)
-    if not df_result.empty:
-        df_result["Cantidad Litros Facturada"] = df_result["Cantidad Litros Facturada"].astype(float)
-        df_result["Litros Transportada"] = df_result["Litros Transportada"].astype(float)
-        df_result = df_result.sort_values(by="FechaEmision", na_position='last').reset_index(drop=True)
-        df_result.drop(columns=["FechaEmision"], inplace=True)
+    # Cada XML es independiente: se procesan en paralelo y se conserva el orden original por índice.
+    max_workers = min(32, os.cpu_count() or 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(process_file_based_on_format, xml_bytes): idx
+            for idx, (xml_name, xml_bytes) in enumerate(xml_blobs)
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            idx = futures[future]
+            xml_name = xml_blobs[idx][0]
+            try:
+                data = future.result()
+                if data:
+                    xml_filename = os.path.basename(xml_name)
+                    data['XML_File'] = xml_filename
+                    data['PDF Asociado'] = identify_pdf(xml_filename, pdf_index)
+                    results[idx] = data
+            except Exception as e:
+                print(f"Error procesando {xml_name}: {e}")
+
+            if progress_bar:
+                progress_bar.progress(done / total_xml)
+
+    # Se ordena por fecha de emisión antes de armar las columnas (sin fecha al final, orden original en empates)
+    all_data = [(data.pop('FechaEmision'), data) for data in results if data is not None]
+    all_data.sort(key=lambda item: (item[0] is None, item[0]))
+
+    # Columnas como listas paralelas para construir el DataFrame una sola vez con sus tipos finales
+    periodo, serie, folio, clave_sat = [], [], [], []
+    facturada, transportada, combustible = [], [], []
+    xml_file, pdf_assoc = [], []
+    for _, data in all_data:
+        periodo.append(data['Periodo'])
+        serie.append(data['Serie'])
+        folio.append(data['Folio'])
+        clave_sat.append(data['Clave SAT'])
+        facturada.append(data['Cantidad Litros Facturada'])
+        transportada.append(data['Litros Transportada'])
+        combustible.append(data['Combustible'])
+        xml_file.append(data['XML_File'])
+        pdf_assoc.append(data['PDF Asociado'])
+
+    df_result = pd.DataFrame({
+        'Periodo': periodo,
+        'Serie': serie,
+        'Folio': folio,
+        'Clave SAT': pd.Categorical(clave_sat),
+        'Cantidad Litros Facturada': _to_liters(facturada),
+        'Litros Transportada': _to_liters(transportada),
+        'Combustible': pd.Categorical(combustible),
+        'XML_File': xml_file,
+        'PDF Asociado': pdf_assoc,
+    })
+    # Comparación vectorizada sobre las columnas completas; los litros se conservan con precisión
+    # completa y solo se formatean a 3 decimales al mostrarlos en `main.py`.
+    fac = df_result['Cantidad Litros Facturada']
+    trans = df_result['Litros Transportada']
+    comparacion = np.where(np.abs(fac - trans) < 1e-9, 'Iguales', 'Diferentes')
+    df_result.insert(df_result.columns.get_loc('Combustible') + 1, 'Comparacion', comparacion)
 
     return df_result, pdf_files
 
-def generar_zip(df: pd.DataFrame, pdf_files: dict) -> bytes:
+@st.cache_data(show_spinner=False, max_entries=4)
+def build_excel_bytes(df: pd.DataFrame) -> bytes:
+    """
+    Genera el archivo Excel con los datos procesados y devuelve su contenido en bytes.
+    Se escribe con `xlsxwriter` en modo `constant_memory`, fila por fila, para que la memoria no
+    crezca con el número de registros. (`DataFrame.to_excel` escribe por columnas, lo que no es
+    compatible con ese modo.)
+    El resultado se guarda en caché de Streamlit con el contenido del DataFrame como llave, por lo
+    que no se vuelve a generar en cada interacción con la interfaz.
+    """
+    excel_buffer = BytesIO()
+    workbook = xlsxwriter.Workbook(excel_buffer, {'constant_memory': True})
+    worksheet = workbook.add_worksheet()
+    worksheet.write_row(0, 0, [str(col) for col in df.columns])
+    # Los valores nulos (NaN/None) se escriben como celdas vacías
+    values = df.astype(object).where(df.notna(), None)
+    for row_idx, row in enumerate(values.itertuples(index=False, name=None), start=1):
+        worksheet.write_row(row_idx, 0, row)
+    workbook.close()
+    return excel_buffer.getvalue()
+
+def generar_zip(df: pd.DataFrame, pdf_files: dict, fmt: Literal['xlsx', 'parquet'] = 'xlsx') -> bytes:
     """
     Genera un ZIP en memoria que incluye:
-      - Un archivo Excel con los datos procesados.
+      - Un archivo con los datos procesados: Excel (`fmt='xlsx'`) o Parquet comprimido con zstd
+        (`fmt='parquet'`), más pequeño y rápido de generar.
       - Los PDFs asociados.
+    Los PDFs y el Parquet ya vienen comprimidos, por lo que se guardan sin recomprimir (`ZIP_STORED`);
+    solo el Excel se comprime, con el nivel más rápido de deflate.
     """
     buffer = BytesIO()
-    with zipfile.ZipFile(buffer, 'w') as zf:
-        excel_buffer = BytesIO()
-        df.to_excel(excel_buffer, index=False)
-        zf.writestr("datos_procesados.xlsx", excel_buffer.getvalue())
+    with zipfile.ZipFile(buffer, 'w', compression=zipfile.ZIP_STORED) as zf:
+        if fmt == 'parquet':
+            parquet_buffer = BytesIO()
+            df.to_parquet(parquet_buffer, engine='pyarrow', compression='zstd', index=False)
+            zf.writestr("datos_procesados.parquet", parquet_buffer.getvalue())
+        else:
+            zf.writestr(
+                "datos_procesados.xlsx", build_excel_bytes(df),
+                compress_type=zipfile.ZIP_DEFLATED, compresslevel=1
+            )
         for pdf_name in df['PDF Asociado'].unique():
             if pdf_name != 'No encontrado' and pdf_name in pdf_files:
-                zf.write(pdf_files[pdf_name], arcname=pdf_name)
+                zf.write(pdf_files[pdf_name], arcname=pdf_name, compress_type=zipfile.ZIP_STORED)
     buffer.seek(0)
     return buffer.getvalue()
+
+def _pdf_files_key(pdf_files: dict) -> tuple:
+    """
+    Llave de caché para el diccionario de PDFs: nombre, fecha de modificación y tamaño de cada
+    archivo, de modo que un PDF reemplazado con el mismo nombre invalida el ZIP en caché.
+    """
+    key = []
+    for name, path in sorted(pdf_files.items()):
+        try:
+            stat = os.stat(path)
+            key.append((name, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            key.append((name, None, None))
+    return tuple(key)
+
+@st.cache_data(show_spinner=False, max_entries=4, hash_funcs={dict: _pdf_files_key})
+def build_zip_bytes(df: pd.DataFrame, pdf_files: dict, fmt: Literal['xlsx', 'parquet'] = 'xlsx') -> bytes:
+    """
+    Versión en caché de `generar_zip`. La llave es el contenido del DataFrame, la identidad de los
+    PDFs disponibles (nombre, fecha de modificación y tamaño) y el formato de los datos, así que el
+    ZIP se reconstruye cuando cambian los datos o alguno de los PDFs. Como cada lote procesado
+    genera una llave nueva, la caché se limita a pocas entradas para no acumular ZIPs en memoria.
+    """
+    return generar_zip(df, pdf_files, fmt)
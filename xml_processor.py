@@ -1,58 +1,51 @@
 # xml_processor.py
 
-import xml.etree.ElementTree as ET
+import threading
+from functools import lru_cache
+from lxml import etree as ET
 from datetime import datetime
-from utils import parse_float, format_and_compare_liters, map_clave_to_combustible
+from utils import _CLAVE_MAP
 
-# Namespace para el CFDI
-NS_CFDI = {'cfdi': 'http://www.sat.gob.mx/cfd/4'}
+# Prefijo de los namespaces del complemento Carta Porte (CartaPorte20, CartaPorte30, CartaPorte31)
+CP_NS_PREFIX = 'http://www.sat.gob.mx/CartaPorte'
+CP_VERSIONS = ('20', '30', '31')
 
-def identify_format(file_path: str) -> str | None:
+# Namespaces y etiquetas en notación Clark (`{uri}Nombre`), calculados una sola vez al cargar el módulo
+_CFDI_NS = 'http://www.sat.gob.mx/cfd/4'
+_CP_NS = {ver: CP_NS_PREFIX + ver for ver in CP_VERSIONS}
+_CONCEPTO = f'{{{_CFDI_NS}}}Concepto'
+_MERCANCIA = {f'{{{uri}}}Mercancia': ver for ver, uri in _CP_NS.items()}
+# Versiones cuyos litros transportados se leen de `CantidadTransporta`; en Carta Porte 2.0 se
+# toman directamente del atributo `Cantidad` de `Mercancia`.
+_CANTTRANS = {ver: f'{{{uri}}}CantidadTransporta' for ver, uri in _CP_NS.items() if ver != '20'}
 
+# Parser de lxml por hilo (ver `_parser`)
+_THREAD_LOCAL = threading.local()
+
+@lru_cache(maxsize=4096)
+def _parse_iso(fecha_str: str) -> datetime | None:
     """
-    Esta función de Python identifica el formato de un archivo basado en la presencia de elementos
-    específicos en la estructura XML.
-    
-    Argumentos:
-      file_path (str): La función `identify_format` toma como entrada la ruta de un archivo e intenta
-    identificar el formato del archivo basado en la presencia de elementos específicos en la estructura
-    XML. Verifica la presencia de ciertos elementos como 'Mercancia' dentro de diferentes espacios de
-    nombres para determinar el formato del archivo.
-    
-    Retorna:
-      La función `identify_format` devuelve una cadena que indica el formato del archivo basado en la
-    presencia de elementos específicos en la estructura XML. Los posibles valores de retorno son
-    'format1', 'format2', 'format31' si se encuentran los elementos correspondientes en el archivo XML.
-    Si no se encuentra ninguno de estos elementos, la función devuelve `None`.
-"""
-    tree = ET.parse(file_path)
-    root = tree.getroot()
-
-    if root.findall('.//cartaporte20:Mercancia', namespaces={'cartaporte20': 'http://www.sat.gob.mx/CartaPorte20'}):
-        return 'format1'
-    elif root.findall('.//cartaporte30:Mercancia', namespaces={'cartaporte30': 'http://www.sat.gob.mx/CartaPorte30'}):
-        return 'format2'
-    elif root.findall('.//cartaporte31:Mercancia', namespaces={'cartaporte31': 'http://www.sat.gob.mx/CartaPorte31'}):
-        return 'format31'
-    else:
+    Convierte una fecha ISO 8601 del CFDI a `datetime`, o `None` si no es válida.
+    Se guarda en caché porque muchas facturas de un mismo lote comparten la misma fecha.
+    """
+    try:
+        return datetime.fromisoformat(fecha_str)
+    except ValueError:
         return None
 
-def extract_common_data(root: ET.Element) -> dict:
+def extract_common_data(root: ET._Element) -> dict:
     """
     Argumentos:
-      root (ET.Element): La función `extract_common_data` toma un elemento XML `root` como entrada y
+      root (ET._Element): La función `extract_common_data` toma un elemento XML `root` como entrada y
     extrae datos comunes como Fecha, Serie, Folio, etc., a partir de los atributos del elemento XML.
     
     Retorna:
       Un diccionario que contiene los datos comunes extraídos del elemento XML, como 'FechaEmision',
-    'Periodo', 'Serie', 'Folio', 'Clave SAT', 'Cantidad Litros Facturada', 'Litros Transportada',
-    'Combustible' y 'Comparacion'.
+    'Periodo', 'Serie', 'Folio', 'Clave SAT', 'Cantidad Litros Facturada', 'Litros Transportada'
+    y 'Combustible'.
     """
     fecha_str = root.attrib.get('Fecha', '')
-    try:
-        fecha_dt = datetime.fromisoformat(fecha_str)
-    except ValueError:
-        fecha_dt = None
+    fecha_dt = _parse_iso(fecha_str) if fecha_str else None
     periodo = str(fecha_dt.month) if fecha_dt else ''
     return {
         'FechaEmision': fecha_dt,
@@ -62,179 +55,76 @@ def extract_common_data(root: ET.Element) -> dict:
         'Clave SAT': None,
         'Cantidad Litros Facturada': None,
         'Litros Transportada': None,
-        'Combustible': None,
-        'Comparacion': ''
+        'Combustible': None
     }
 
-def process_xml_format1(file_path: str) -> dict:
+def _parser() -> ET.XMLParser:
     """
-    La función `process_xml_format1` analiza un archivo XML, extrae elementos de datos específicos,
-    realiza cálculos sobre los datos extraídos y devuelve un diccionario con la información procesada.
-    
-    Argumentos:
-      file_path (str): La función `process_xml_format1` procesa un archivo XML para extraer datos
-    específicos relacionados con la facturación y el transporte. Extrae datos comunes, como la cantidad
-    facturada y transportada, así como el tipo de combustible transportado.
-    
-    Retorna:
-      La función `process_xml_format1` devuelve un diccionario `data` que contiene los datos extraídos
-    de un archivo XML especificado por `file_path`. Los datos extraídos incluyen información común,
-    cantidad facturada en litros, cantidad transportada en litros, código SAT, tipo de combustible y un
-    resultado de comparación entre los litros facturados y transportados.
-"""
-
-    tree = ET.parse(file_path)
-    root = tree.getroot()
-    data = extract_common_data(root)
-    
-    # Cantidad facturada
-    concepto = root.find('.//cfdi:Concepto', namespaces=NS_CFDI)
-    if concepto is not None:
-        data['Cantidad Litros Facturada'] = concepto.attrib.get('Cantidad', '')
-    
-    # Cantidad transportada y mapeo de combustible
-    mercancia = root.find('.//cartaporte20:Mercancia', namespaces={'cartaporte20': 'http://www.sat.gob.mx/CartaPorte20'})
-    if mercancia is not None:
-        clave_prod_serv = mercancia.attrib.get('BienesTransp', '')
-        data['Clave SAT'] = clave_prod_serv
-        data['Litros Transportada'] = mercancia.attrib.get('Cantidad', '')
-        data['Combustible'] = map_clave_to_combustible(clave_prod_serv)
-    
-    fac, trans, comp = format_and_compare_liters(
-        data['Cantidad Litros Facturada'] or '0',
-        data['Litros Transportada'] or '0'
-    )
-    data['Cantidad Litros Facturada'] = fac
-    data['Litros Transportada'] = trans
-    data['Comparacion'] = comp
-    return data
+    Devuelve el parser de lxml del hilo actual. Se reutiliza entre archivos, pero un mismo parser
+    no debe usarse desde varios hilos a la vez, por eso hay uno por hilo del `ThreadPoolExecutor`.
+    """
+    parser = getattr(_THREAD_LOCAL, 'parser', None)
+    if parser is None:
+        parser = ET.XMLParser(huge_tree=False, remove_blank_text=True, collect_ids=False)
+        _THREAD_LOCAL.parser = parser
+    return parser
 
-def process_xml_format2(file_path: str) -> dict:
+def _fast_extract(file_bytes: bytes) -> dict | None:
+    """
+    Extrae los datos de un XML de Carta Porte con un solo análisis de lxml. Lee los atributos del
+    elemento raíz `Comprobante` (Fecha, Serie, Folio), la `Cantidad` del primer `Concepto` de
+    CFDI 4.0, `BienesTransp` y `Cantidad` de la primera `Mercancia` de Carta Porte y la `Cantidad`
+    de su `CantidadTransporta`. Las búsquedas usan `iter()` con las etiquetas en notación Clark,
+    que lxml filtra en C sin pasar cada nodo por Python.
+    La versión de Carta Porte se obtiene del namespace de la etiqueta `Mercancia` y todas las versiones
+    comparten este mismo recorrido; lo único que cambia por versión son las etiquetas de `_MERCANCIA`
+    y `_CANTTRANS` (en Carta Porte 2.0 los litros transportados se toman directamente de `Mercancia`).
 
+    Retorna `None` si el XML no contiene una mercancía de Carta Porte 2.0, 3.0 o 3.1.
     """
+    root = ET.fromstring(file_bytes, _parser())
+
+    mercancia = next(root.iter(*_MERCANCIA), None)
+    if mercancia is None:
+        return None
+    version = _MERCANCIA[mercancia.tag]
 
-    Argumentos:
-      file_path (str): El parámetro `file_path` en la función `process_xml_format2` es una cadena que
-    representa la ruta del archivo XML que se desea procesar. Esta función lee el archivo XML, extrae
-    datos específicos de él y devuelve un diccionario con la información procesada.
-    
-    Retorna:
-      Un diccionario que contiene los datos procesados extraídos del archivo XML en formato CartaPorte30
-    (format2), incluyendo datos comunes, cantidad de litros facturados, código SAT, cantidad de litros
-    transportados, tipo de combustible, cantidad de litros facturados formateada, cantidad de litros
-    transportados formateada y un resultado de comparación.
-"""
-    tree = ET.parse(file_path)
-    root = tree.getroot()
     data = extract_common_data(root)
-    
-    concepto = root.find('.//cfdi:Concepto', namespaces=NS_CFDI)
-    if concepto is not None:
-        data['Cantidad Litros Facturada'] = concepto.attrib.get('Cantidad', '')
-    
-    mercancia = root.find('.//cartaporte30:Mercancia', namespaces={'cartaporte30': 'http://www.sat.gob.mx/CartaPorte30'})
-    if mercancia is not None:
-        clave_prod_serv = mercancia.attrib.get('BienesTransp', '')
-        data['Clave SAT'] = clave_prod_serv
-        
-        cantidad_transporta = mercancia.find(
-            './/cartaporte30:CantidadTransporta',
-            namespaces={'cartaporte30': 'http://www.sat.gob.mx/CartaPorte30'}
-        )
-        if cantidad_transporta is not None:
-            data['Litros Transportada'] = cantidad_transporta.attrib.get('Cantidad', '')
-        else:
-            data['Litros Transportada'] = mercancia.attrib.get('Cantidad', '')
-        data['Combustible'] = map_clave_to_combustible(clave_prod_serv)
-    
-    fac, trans, comp = format_and_compare_liters(
-        data.get('Cantidad Litros Facturada', '0'),
-        data.get('Litros Transportada', '0')
-    )
-    data['Cantidad Litros Facturada'] = fac
-    data['Litros Transportada'] = trans
-    data['Comparacion'] = comp
-    return data
 
-def process_xml_format31(file_path: str) -> dict:
-    """"Procesa un archivo XML en el formato "Carta Porte 3.1" y extrae datos relevantes.
-        file_path (str): La ruta al archivo XML que se va a procesar.
-        dict: Un diccionario que contiene los datos extraídos, incluyendo:
-            - 'Cantidad Litros Facturada': La cantidad de litros facturada, extraída del nodo 'cfdi:Concepto'.
-            - 'Clave SAT': La clave SAT de los bienes transportados, extraída del nodo 'cartaporte31:Mercancia'.
-            - 'Litros Transportada': La cantidad de litros transportados, extraída del nodo 'cartaporte31:CantidadTransporta' o del nodo 'cartaporte31:Mercancia'.
-            - 'Combustible': El tipo de combustible, mapeado a partir de la clave SAT.
-            - 'Comparacion': Un resultado de comparación entre los litros facturados y los litros transportados.
-    """
+    concepto = next(root.iter(_CONCEPTO), None)
+    facturada = concepto.get('Cantidad', '') if concepto is not None else None
 
-    tree = ET.parse(file_path)
-    root = tree.getroot()
-    data = extract_common_data(root)
-    
-    concepto = root.find('.//cfdi:Concepto', namespaces=NS_CFDI)
-    if concepto is not None:
-        data['Cantidad Litros Facturada'] = concepto.attrib.get('Cantidad', '')
-    
-    mercancia = root.find(
-        './/cartaporte31:Mercancia',
-        namespaces={'cartaporte31': 'http://www.sat.gob.mx/CartaPorte31'}
-    )
-    if mercancia is not None:
-        clave_prod_serv = mercancia.attrib.get('BienesTransp', '')
-        data['Clave SAT'] = clave_prod_serv
-        
-        cantidad_transporta_node = mercancia.find(
-            './/cartaporte31:CantidadTransporta',
-            namespaces={'cartaporte31': 'http://www.sat.gob.mx/CartaPorte31'}
-        )
-        if cantidad_transporta_node is not None:
-            data['Litros Transportada'] = cantidad_transporta_node.attrib.get('Cantidad', '')
-        else:
-            data['Litros Transportada'] = mercancia.attrib.get('Cantidad', '')
-        data['Combustible'] = map_clave_to_combustible(clave_prod_serv)
-    
-    fac, trans, comp = format_and_compare_liters(
-        data.get('Cantidad Litros Facturada', '0'),
-        data.get('Litros Transportada', '0')
-    )
-    data['Cantidad Litros Facturada'] = fac
-    data['Litros Transportada'] = trans
-    data['Comparacion'] = comp
+    transportada = None
+    if version in _CANTTRANS:
+        cantidad_transporta = next(mercancia.iter(_CANTTRANS[version]), None)
+        if cantidad_transporta is not None:
+            transportada = cantidad_transporta.get('Cantidad', '')
+    if transportada is None:
+        transportada = mercancia.get('Cantidad', '')
+
+    clave_prod_serv = mercancia.get('BienesTransp', '')
+    data['Clave SAT'] = clave_prod_serv
+    data['Combustible'] = _CLAVE_MAP.get(clave_prod_serv)
+    # Se guardan los valores crudos; la conversión a float y la comparación se hacen de forma
+    # vectorizada sobre el DataFrame completo en `process_uploaded_files`.
+    data['Cantidad Litros Facturada'] = facturada
+    data['Litros Transportada'] = transportada
     return data
 
-def process_file_based_on_format(file_path: str) -> dict | None:
+def process_file_based_on_format(file_bytes: bytes) -> dict | None:
     """
-    Procesa un archivo basado en su formato identificado.
-    Este método toma la ruta de un archivo, identifica su formato utilizando la función
-    `identify_format` y luego llama a la función de procesamiento correspondiente según
-    el formato identificado. Si el formato no es reconocido, devuelve `None`.
+    Procesa el contenido de un XML de Carta Porte (versiones 2.0, 3.0 y 3.1).
+    El archivo se analiza una sola vez con `_fast_extract`, que detecta la versión a partir del
+    namespace de la mercancía. Si la versión no es reconocida, devuelve `None`.
     Parámetros:
     -----------
-    file_path : str
-        La ruta completa del archivo que se desea procesar.
+    file_bytes : bytes
+        El contenido completo del archivo XML que se desea procesar.
     Retorna:
     --------
     dict | None
         Un diccionario con los datos procesados si el formato es reconocido y procesado
         correctamente. Si el formato no es reconocido, devuelve `None`.
-    Formatos soportados:
-    --------------------
-    - 'format1': Procesado por la función `process_xml_format1`.
-    - 'format2': Procesado por la función `process_xml_format2`.
-    - 'format31': Procesado por la función `process_xml_format31`.
-    Nota:
-    -----
-    Asegúrese de que las funciones `identify_format`, `process_xml_format1`, 
-    `process_xml_format2` y `process_xml_format31` estén correctamente implementadas 
-    y disponibles en el entorno donde se ejecuta esta función.
     """
 
-    format_type = identify_format(file_path)
-    if format_type == 'format1':
-        return process_xml_format1(file_path)
-    elif format_type == 'format2':
-        return process_xml_format2(file_path)
-    elif format_type == 'format31':
-        return process_xml_format31(file_path)
-    else:
-        return None
+    return _fast_extract(file_bytes)